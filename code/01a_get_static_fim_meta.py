@@ -2,8 +2,8 @@
 # contributors:         Benjamin Sipprell - usgs and ahps fim info
 # contact info:         henry <dot> pai <at> noaa <dot> gov
 # last edit by:         hp
-# last edit time:       Oct 2024
-# last edit comment:    added nws esri scraper, adjust dem resolution to meters
+# last edit time:       Aug 2026
+# last edit comment:    performance pass, starting with concurrent per-site scraping
 
 # summary:
 # aggregates various location and impact/thresholds metadata to both automate and enhance some data entry for
@@ -63,21 +63,35 @@
 # [x] Fill in metadata for FEMA Hazard Layer age at gage
 # [ ] Should probably be transformed to OOP if further expanded to above fields... just joining different databases.
 
+import concurrent.futures
+import functools
 import glob
+import multiprocessing
 import os
 import pathlib
 import pandas as pd
 import numpy as np
 import json
 import logging
-import urllib
+import re
 import urllib3
 import time
 import yaml
-import pdb
+from urllib.parse import urlencode
+
+# orjson parses response bytes directly (skips the utf8 decode pass) and is several times faster
+# than stdlib json; quietly fall back when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # ===== global/user vars (not path related)
 get_partner = False  # gets usgs DEM and fema hazard info if True
+max_fetch_workers = 32  # concurrent requests for the per-site scraping, bounded to be polite to the api's
+use_cache = True  # keeps responses on disk so reruns (e.g., after a timeout) skip the network
+cache_ttl_hr = 24
 
 # in NWPS, if both flow and stage are populated, the code takes care of 'most cases' in the function: check_threshold_type
 # the site below is still a flow threshold site, but has both flow and stage populated in the api metadata
@@ -99,6 +113,7 @@ flow_dir = os.path.join(in_dir, "flow")
 nonhand_fim_dir = os.path.join(in_dir, 'nonhand_fim')
 log_dir = os.path.join(work_dir, "logs")
 out_dir = os.path.join(work_dir, "out", "catfim")
+cache_dir = os.path.join(work_dir, "cache", "nwps")  # created on demand when use_cache is on
 
 # yaml file
 yaml_fn = 'config.yaml'
@@ -134,6 +149,10 @@ with open(os.path.join(ctrl_dir, yaml_fn)) as f:
     org_static_fims_fn_suffix2 = '_' + yaml_data['station_src'] + 'Stalist' + org_static_fims_fn_suffix1
     nwps_impact_fn_suffix2 = '_' + yaml_data['station_src'] + 'Stalist' + nwps_impact_fn_suffix1
 
+# ===== precompiled patterns for clean_stage_df, so each column parses in a single pass
+map_link_re = re.compile(r'loc:([^+]+)\+(\S+)')
+timestamp_re = re.compile(r'updated:\s*(\S+)')
+
 # ===== url info
 nwps_base_url = 'https://api.water.noaa.gov/nwps/v1/gauges/'
 rtgs_post_str = 'ratings'
@@ -148,14 +167,51 @@ flow_base_url = 'https://maps.water.noaa.gov/server/rest/services/fim_libs/stati
 stage_base_url = 'https://maps.water.noaa.gov/server/rest/services/fim_libs/static_stage_based_catfim/MapServer/0/query?'
 
 # ===== initial set up for requests and logging
+# one shared connection pool sized to the fetch workers; building a PoolManager per request threw
+# away keep-alive connections and paid a fresh tls handshake every call
+# needed to turn this cert off for home
+#http = urllib3.PoolManager(cert_reqs='CERT_NONE')
+http = urllib3.PoolManager(maxsize=max_fetch_workers,
+                           retries=urllib3.Retry(total=3, backoff_factor=0.5))
+
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s',
                     filename=os.path.join(log_dir, log_fn),
-                    filemode='w',
+                    # aoi worker processes re-import this module; only the parent truncates the log
+                    filemode='w' if multiprocessing.current_process().name == 'MainProcess' else 'a',
                     #level=logging.DEBUG,
                     level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 # ===== functions
+class CachedResponse:
+    """minimal stand-in for an urllib3 response reconstituted from the disk cache"""
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+def cached_request(url, cache_key):
+    """
+    GET with a small on-disk cache so reruns within the ttl skip the network entirely
+    the status code sits on the first line of the cache file ahead of the raw body
+    """
+    cache_fullfn = os.path.join(cache_dir, cache_key)
+    if use_cache and os.path.exists(cache_fullfn) and (time.time() - os.path.getmtime(cache_fullfn)) < cache_ttl_hr * 3600:
+        with open(cache_fullfn, 'rb') as cache_f:
+            status_line, body = cache_f.read().split(b'\n', 1)
+        return CachedResponse(int(status_line), body)
+
+    response = http.request('GET', url, headers = request_header)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write-then-replace keeps the cache atomic if a run is killed mid-write
+        tmp_fullfn = cache_fullfn + '.tmp'
+        with open(tmp_fullfn, 'wb') as cache_f:
+            cache_f.write(str(response.status).encode() + b'\n' + response.data)
+        os.replace(tmp_fullfn, cache_fullfn)
+
+    return response
+
 def convert_fim_json_df(aoi, param):
     """
     dealing with fim geodatabase json output (see above links), with some nesting
@@ -170,8 +226,8 @@ def convert_fim_json_df(aoi, param):
         elif param == 'flow':
             fullfn = os.path.join(flow_dir, aoi + flow_fn_suffix)
 
-        with open(fullfn) as json_data:
-            j_data = json.load(json_data)
+        with open(fullfn, 'rb') as json_data:
+            j_data = json_loads(json_data.read())
 
     elif yaml_data['station_src'] == 'online':
         if param == 'stage':
@@ -186,10 +242,6 @@ def convert_fim_json_df(aoi, param):
         
         aoi_caps = aoi.upper()
 
-        # needed to turn this cert off for home
-        #http = urllib3.PoolManager(cert_reqs='CERT_NONE')
-        http = urllib3.PoolManager()
-
         nws_esri_params = {
                     'where': query_loc_id + " = '" + aoi_caps + "'",
                     'returnGeometry': 'false',
@@ -197,14 +249,15 @@ def convert_fim_json_df(aoi, param):
                     'f': 'pjson'
                 }
         
-        nws_esri_url = nws_esri_base_url + urllib.parse.urlencode(nws_esri_params)
+        nws_esri_url = nws_esri_base_url + urlencode(nws_esri_params)
         nws_esri_response = http.request('GET', nws_esri_url, headers = request_header)
-        j_data = json.loads(nws_esri_response.data.decode('utf8'))
+        j_data = json_loads(nws_esri_response.data)
     else:
         logging.error('incorrect flow/stage source chosen (offline/online)')
 
-    dict_df = pd.DataFrame(j_data['features'])
-    org_df = pd.DataFrame(list(dict_df['attributes'])) # probably has a more pythonic, cleaner way
+    # attributes share the same keys, so from_records over a generator builds the frame in one
+    # pass instead of a features frame plus a list materialization of every attributes dict
+    org_df = pd.DataFrame.from_records(feature['attributes'] for feature in j_data['features'])
 
     return org_df
 
@@ -216,12 +269,12 @@ def clean_stage_df(df):
     - nrldb_timestamp   -> just put "update" & "tz" in column name, only have timestamp in entry
     - nwis_timestamp    -> same as above
     """
-    # splitting lat lon
-    lat_lon = df['nws_data_map_link'].str.split("loc:").str[1].str.split("+", expand=True)
-    
+    # splitting lat lon, one extract traversal instead of chained str.split passes
+    lat_lon = df['nws_data_map_link'].str.extract(map_link_re)
+
     # stripping some text, think date is fine for this field
-    nrldb_date_updated = df['nrldb_timestamp'].str.split('updated: ').str[1].str.split(' ').str[0]
-    nwis_date_updated = df['nwis_timestamp'].str.split('updated: ').str[1].str.split(' ').str[0]
+    nrldb_date_updated = df['nrldb_timestamp'].str.extract(timestamp_re, expand=False)
+    nwis_date_updated = df['nwis_timestamp'].str.extract(timestamp_re, expand=False)
 
     df['lat'] = lat_lon[0]
     df['lon'] = lat_lon[1]
@@ -232,73 +285,105 @@ def clean_stage_df(df):
 
     return return_df
 
-def check_threshold_type(lid, obs_primary_unit, thresholds_df, rating_df, impacts_df):
+def classify_threshold_types(lids, gage_jsons):
     """
-    returns amended df to thresholds with impacts, rated variable, and adds max rating info
+    vectorized version of the old per-lid if/elif ladder (np.select over all sites at once)
+    note, change in logic looking at primary unit in observed data (recommended by Crane Johnson via GChat)
+    returns dict of lid -> threshold type ('stage'/'flow')
     """
-    # -9999 for missing threshold value
-    threshold_check = thresholds_df[thresholds_df < 0].count()
-
-    # this check won't necessarily work if there are mixed flow and stage thresholds
-    # note, change in logic looking at primary unit in observed data (recommended by Crane Johnson via GChat)
-    if obs_primary_unit == '':
-        if threshold_check['flow'] > threshold_check['stage']:
-            threshold_type = 'stage'
-        elif threshold_check['flow'] == threshold_check['stage']:
-            # several sites have both stage and flow entered
-            if lid in exception_li:
-                threshold_type = 'flow'
-            else:
-                threshold_type = 'stage'
+    exception_set = frozenset(exception_li)
+
+    flow_neg_cnt = []
+    stage_neg_cnt = []
+    primary_unit = []
+    for gage_json in gage_jsons:
+        if gage_json is None:
+            # no nwps metadata; the site is skipped downstream so the values just need to exist
+            flow_neg_cnt.append(0)
+            stage_neg_cnt.append(0)
+            primary_unit.append('')
         else:
-            threshold_type = 'flow'
-    elif obs_primary_unit == 'kcfs':
-        threshold_type = 'flow'
-    elif obs_primary_unit == 'ft':
-        threshold_type = 'stage'
+            # -9999 for missing threshold value
+            categories = gage_json['flood']['categories'].values()
+            flow_neg_cnt.append(sum(1 for category in categories if category['flow'] < 0))
+            stage_neg_cnt.append(sum(1 for category in categories if category['stage'] < 0))
+            primary_unit.append(gage_json['status']['observed']['primaryUnit'])
 
+    class_df = pd.DataFrame({'lid': lids,
+                             'flow_neg_cnt': flow_neg_cnt,
+                             'stage_neg_cnt': stage_neg_cnt,
+                             'primary_unit': primary_unit})
+
+    # this check won't necessarily work if there are mixed flow and stage thresholds
+    # several sites have both stage and flow entered, hence the exception list
+    conditions = [class_df['primary_unit'].eq('kcfs'),
+                  class_df['primary_unit'].eq('ft'),
+                  class_df['flow_neg_cnt'].gt(class_df['stage_neg_cnt']),
+                  class_df['flow_neg_cnt'].eq(class_df['stage_neg_cnt']) & class_df['lid'].isin(exception_set),
+                  class_df['flow_neg_cnt'].eq(class_df['stage_neg_cnt'])]
+    choices = ['flow', 'stage', 'stage', 'flow', 'stage']
+    class_df['threshold_type'] = np.select(conditions, choices, default='flow')
+
+    return dict(zip(class_df['lid'], class_df['threshold_type']))
+
+def check_threshold_type(lid, threshold_type, thresholds_df, rating_stages, rating_flows, impacts_df):
+    """
+    returns amended df to thresholds with impacts, rated variable, and adds max rating info
+    threshold type itself now comes precomputed from classify_threshold_types
+    """
     # filter -9999 values, like missing moderate, major categories
     org_thresholds_df = thresholds_df[thresholds_df[threshold_type] >=0].reset_index().rename(columns={'index':'category'})
 
     if not org_thresholds_df.empty:
-        if threshold_check['flow'] == threshold_check['stage']:
+        if (thresholds_df['flow'] < 0).sum() == (thresholds_df['stage'] < 0).sum():
             logging.info(lid + ' has both flow and stage thresholds defined.')
 
+    # joins threshold and impacts table, fills in missing stages/flows depending on threshold type
+    # union of (impacts left-merged onto thresholds) and the unmatched thresholds instead of one
+    # outer merge; the left merge keeps one row per matching category when two categories share a
+    # threshold value, same as the old outer merge
+    org_cols = org_thresholds_df.columns.tolist() + ['statement']
+
     if impacts_df.empty:
-        impacts_df['impact_val'] = None
-        impacts_df['statement'] = None
+        org_df = org_thresholds_df.assign(statement=None).sort_values(threshold_type)
     else:
         impacts_df.rename(columns={impacts_df.columns[0]:'impact_val'}, inplace=True)
 
-    # joins threshold and impacts table, fills in missing stages/flows depending on threshold type
-    thresh_imp_df = org_thresholds_df.merge(impacts_df, left_on=threshold_type, right_on='impact_val', how='outer')
-    thresh_imp_df['merge_thresholds'] = thresh_imp_df[threshold_type].where(thresh_imp_df[threshold_type].notnull(), thresh_imp_df['impact_val'])
-    thresh_imp_df[threshold_type] = thresh_imp_df['merge_thresholds']
-        
-    org_df = thresh_imp_df.drop(['merge_thresholds', 'impact_val'], axis=1).sort_values(threshold_type)
+        imp_df = impacts_df[['impact_val', 'statement']].merge(org_thresholds_df,
+                                                               how='left',
+                                                               left_on='impact_val',
+                                                               right_on=threshold_type)
+        imp_df[threshold_type] = imp_df['impact_val']  # impacts without a threshold match keep their value
+        unmatched_thr_df = org_thresholds_df[~org_thresholds_df[threshold_type].isin(impacts_df['impact_val'])].assign(statement=None)
+
+        org_df = pd.concat([imp_df, unmatched_thr_df], ignore_index=True)[org_cols].sort_values(threshold_type)
 
-    if rating_df.empty:
+    if rating_stages.size == 0:
         logging.info('no nws rating for ' + lid)
         max_stg = -9999
         max_flow = -9999
     else:
-        rating_max = rating_df.max()
-        max_stg = rating_max['stage']
-        max_flow = rating_max['flow']
-        
+        max_stg = rating_stages.max()
+        max_flow = rating_flows.max()
+
         # applies missing threshold variable to rating.  if stage-flow pair doesn't exist, does linear interpolation.  no ratings extensions
+        # handing np.interp plain float ndarrays skips the per-call series dtype inference
         if threshold_type == 'stage':
-            org_df['flow'] = np.round(np.interp(org_df['stage'], rating_df['stage'], rating_df['flow'], left=-9999, right=-9999), 0)
+            rating_x, rating_y, rated_var, query_var, decimals = rating_stages, rating_flows, 'flow', 'stage', 0
         else:
-            org_df['stage'] = np.round(np.interp(org_df['flow'], rating_df['flow'], rating_df['stage'], left=-9999, right=-9999), 2)
+            rating_x, rating_y, rated_var, query_var, decimals = rating_flows, rating_stages, 'stage', 'flow', 2
+
+        org_df[rated_var] = np.round(np.interp(org_df[query_var].to_numpy(dtype=float),
+                                               rating_x, rating_y, left=-9999, right=-9999), decimals)
 
     return_df = org_df
 
-    return threshold_type, max_stg, max_flow, return_df
+    return max_stg, max_flow, return_df
 
 def add_meta_cols(df, threshold_type, max_stg, max_flow, dem_resolution, dem_yr, ahps_fim_exist, usgs_fim_exist, usgs_fim_yr, fema_effective_date, fema_older_dem, rfc_headwater):
     """
     tacking on extra metadata columns, ones with single values
+    works on a df or a plain dict row, both use the same key assignment
     """
     df['threshold_type'] = threshold_type
     df['rfc_headwater'] = rfc_headwater
@@ -337,6 +422,45 @@ def map_meter_resolution(dem_json):
     
     return meter_res
 
+def fetch_lid_urls(row):
+    """
+    runs the per-site GET calls (nwps rating & gage, plus partner dem/fema when requested)
+    returns dict of urllib3 responses keyed by source so parsing can happen after all fetches
+    """
+    lid = row.ahps_lid
+    gage_url = nwps_base_url + lid
+    rating_url = nwps_base_url + lid + "/" + rtgs_post_str
+    lon = row.lon
+    lat = row.lat
+
+    responses = {}
+
+    # getting rating info for max stage & flow
+    responses['rating'] = cached_request(rating_url, lid + '_rating')
+
+    # getting thresholds and impacts info
+    responses['gage'] = cached_request(gage_url, lid + '_gage')
+
+    if get_partner:
+        # getting dem info - resolution (though unclear what this value represents) and aquisition date
+        # example dem url: https://epqs.nationalmap.gov/v1/json?x=-122.59&y=45.53&wkid=4326&units=Feet&includeDate=true
+        dem_url = dem_base_url + 'x=' + lon + '&y=' + lat + dem_base_suffix_url
+        responses['dem'] = cached_request(dem_url, lid + '_dem')
+
+        # getting fema info
+        # some help: https://gis.stackexchange.com/questions/427434/query-feature-service-on-esri-arcgis-rest-api-with-python-requests
+        fema_params = {
+            'geometry': str(lon) + ',' + str(lat),
+            'geometryType': 'esriGeometryPoint',
+            'returnGeometry': 'false',
+            'outFields': '*',
+            'f': 'pjson'
+        }
+        fema_url = fema_base_url + urlencode(fema_params)
+        responses['fema'] = cached_request(fema_url, lid + '_fema')
+
+    return responses
+
 def get_site_info(fims_df, aoi):
     """
     Gets site information that can be downloaded/obtained in bulk & needs to be looped at a per site level
@@ -346,94 +470,99 @@ def get_site_info(fims_df, aoi):
     """
     loop_li = [] # big loop to combine impacts into multiple rows per lid
     site_li = [] # organized site info
+    impact_li = [] # thresholds & impacts tables, one per lid
 
     df = fims_df.reset_index(drop=True)
 
+    # output paths assembled once per aoi
+    org_static_fims_path = os.path.join(out_dir, out_fn_prefix + aoi + org_static_fims_fn_suffix2)
+    nwps_impact_path = os.path.join(out_dir, out_fn_prefix + aoi + nwps_impact_fn_suffix2)
+    combined_out_path = os.path.join(out_dir, out_fn_prefix + aoi + combined_out_fn_suffix2)
+
     # loading nonhand fim info
-    with open(os.path.join(nonhand_fim_dir, ahps_fim_fn)) as ahps_fim_f:
-        ahps_fim_json = json.load(ahps_fim_f)
-    
-    with open(os.path.join(nonhand_fim_dir, usgs_fim_fn)) as usgs_fim_f:
-        usgs_fim_json = json.load(usgs_fim_f)
+    with open(os.path.join(nonhand_fim_dir, ahps_fim_fn), 'rb') as ahps_fim_f:
+        ahps_fim_json = json_loads(ahps_fim_f.read())
+
+    with open(os.path.join(nonhand_fim_dir, usgs_fim_fn), 'rb') as usgs_fim_f:
+        usgs_fim_json = json_loads(usgs_fim_f.read())
 
     ahps_fim_df = pd.DataFrame(ahps_fim_json['features'])
     ahps_fim_df['ahps_lid'] = ahps_fim_df['ahps_lid'].str.lower()
 
     usgs_fim_df = pd.json_normalize(usgs_fim_json['features'])
 
+    # partner fim presence as one vectorized left join each, so the loop just reads columns
+    df = df.merge(ahps_fim_df[['ahps_lid']].drop_duplicates().assign(ahps_fim='yes'),
+                  on='ahps_lid', how='left').fillna({'ahps_fim': 'no'})
+
+    usgs_fim_slim_df = usgs_fim_df[['attributes.AHPS_ID', 'attributes.STUDY_DATE']]\
+                                  .drop_duplicates(subset='attributes.AHPS_ID')\
+                                  .rename(columns={'attributes.AHPS_ID': 'ahps_lid',
+                                                   'attributes.STUDY_DATE': 'usgs_fim_yr'})\
+                                  .assign(usgs_fim='yes')
+    df = df.merge(usgs_fim_slim_df, on='ahps_lid', how='left').fillna({'usgs_fim': 'no', 'usgs_fim_yr': ''})
+
     if get_partner == False:
         # has to have prior source of data from similar station source (offline/online)
         files_li = glob.glob(out_dir + '/*_' + aoi + org_static_fims_fn_suffix2)
         last_partner_fullfn = max(files_li, key=os.path.getctime)
         partner_df = pd.read_csv(last_partner_fullfn).fillna('')
+        # plain nested dict keyed by lid; .loc on an indexed frame still pays pandas dispatch per hit
+        partner_dict = partner_df.drop_duplicates(subset='ahps_lid')\
+                                 .set_index('ahps_lid')[['dem_res_m', 'dem_yr', 'fema_eff_date']]\
+                                 .to_dict('index')
         logging.info('site scraping for nwps only, nationalmaps and fema data pulled from: ' + os.path.split(last_partner_fullfn)[1])
     else:
         logging.info('site scraping (nwps, nationalmaps, fema) begins')
     
-    external_count = 0
-    for i, row in df.iloc[start_index:].iterrows():
-        lid = row['ahps_lid']
+    # fetch stage: the per-site url calls are network-latency bound, so the requests fan out over a
+    # bounded thread pool sharing one connection pool.  parsing/pandas assembly stays serial below
+    # itertuples skips the per-row Series boxing that iterrows paid on every iteration
+    fetch_rows = list(df.iloc[start_index:].itertuples())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_fetch_workers) as executor:
+        all_responses = list(executor.map(fetch_lid_urls, fetch_rows))
+
+    # decoding the nwps responses once so the threshold type can be classified for all sites
+    # in a single vectorized pass before the assembly loop
+    # note, this assumes nwps posts observed (think so for all sites? not sure) and forecasts (seems like rfc's don't necessarily send?).  will stick with observed
+    rating_jsons = [json_loads(responses['rating'].data) for responses in all_responses]
+    gage_jsons = [json_loads(responses['gage'].data) if responses['gage'].status == 200 else None
+                  for responses in all_responses]
+    threshold_type_dict = classify_threshold_types([fetch_row.ahps_lid for fetch_row in fetch_rows], gage_jsons)
+
+    for row, responses, gage_json, rating_json in zip(fetch_rows, all_responses, gage_jsons, rating_jsons):
+        i = row.Index
+        lid = row.ahps_lid
         gage_url = nwps_base_url + lid
-        rating_url = nwps_base_url + lid + "/" + rtgs_post_str
-        lon = row['lon']
-        lat = row['lat']
-        # example dem url: https://epqs.nationalmap.gov/v1/json?x=-122.59&y=45.53&wkid=4326&units=Feet&includeDate=true
-        dem_url = dem_base_url + 'x=' + lon + '&y=' + lat + dem_base_suffix_url
 
-        http = urllib3.PoolManager()
-
-        # getting rating info for max stage & flow
-        rating_response = http.request('GET', rating_url, headers = request_header)
-        rating_json = json.loads(rating_response.data.decode('utf8'))
-        rating_df = pd.DataFrame(rating_json['data'])
-
-        # getting thresholds and impacts info
-        gage_response = http.request('GET', gage_url, headers = request_header)
-        gage_json = json.loads(gage_response.data.decode('utf8'))
-
-        if get_partner: 
-            # getting dem info - resolution (though unclear what this value represents) and aquisition date
-            #pdb.set_trace()
-            dem_response = http.request('GET', dem_url, headers=request_header)
-            dem_json = json.loads(dem_response.data.decode('utf8'))
-
-            # getting fema info
-            # some help: https://gis.stackexchange.com/questions/427434/query-feature-service-on-esri-arcgis-rest-api-with-python-requests
-            fema_params = {
-                'geometry': str(lon) + ',' + str(lat),
-                'geometryType': 'esriGeometryPoint',
-                'returnGeometry': 'false',
-                'outFields': '*',
-                'f': 'pjson'
-            }
-            fema_url = fema_base_url + urllib.parse.urlencode(fema_params)
-            fema_response = http.request('GET', fema_url, headers = request_header)
-            fema_json = json.loads(fema_response.data.decode('utf8'))
+        # typed arrays straight from the json; the rating only feeds max() and np.interp, so a
+        # full DataFrame construction per lid was wasted work
+        rating_data = rating_json['data']
+        rating_stages = np.fromiter((point['stage'] for point in rating_data), dtype=np.float64, count=len(rating_data))
+        rating_flows = np.fromiter((point['flow'] for point in rating_data), dtype=np.float64, count=len(rating_data))
+
+        gage_response = responses['gage']
+
+        if get_partner:
+            dem_response = responses['dem']
+            dem_json = json_loads(dem_response.data)
+
+            fema_response = responses['fema']
+            fema_json = json_loads(fema_response.data)
 
         # checking if metadata exists
         if gage_response.status == 200:
             thresholds_df = pd.DataFrame(gage_json['flood']['categories']).transpose()
             impacts_df = pd.DataFrame(gage_json['flood']['impacts'])
-            status_df = pd.DataFrame(gage_json['status'])
-
-            # note, this assumes nwps posts observed (think so for all sites? not sure) and forecasts (seems like rfc's don't necessarily send?).  will stick with observed
-            obs_primary_unit = status_df['observed']['primaryUnit']
 
             # building thresholds & impacts info into expanded table with more roows
-            threshold_type, max_stg, max_flow, thresh_imp_df = check_threshold_type(lid, obs_primary_unit, thresholds_df, rating_df, impacts_df)
+            threshold_type = threshold_type_dict[lid]
+            max_stg, max_flow, thresh_imp_df = check_threshold_type(lid, threshold_type, thresholds_df, rating_stages, rating_flows, impacts_df)
 
-            # from Benjamin, metadata for partner fims
-            if ahps_fim_df[ahps_fim_df['ahps_lid'] == lid].empty:
-                ahps_fim_exist = 'no'
-            else:
-                ahps_fim_exist = 'yes'
-
-            if usgs_fim_df[usgs_fim_df['attributes.AHPS_ID'] == lid].empty:
-                usgs_fim_exist = 'no'
-                usgs_fim_yr = ''
-            else:
-                usgs_fim_exist = 'yes'
-                usgs_fim_yr = usgs_fim_df[usgs_fim_df['attributes.AHPS_ID'] == lid]['attributes.STUDY_DATE'].values[0]
+            # from Benjamin, metadata for partner fims (precomputed by the joins above)
+            ahps_fim_exist = row.ahps_fim
+            usgs_fim_exist = row.usgs_fim
+            usgs_fim_yr = row.usgs_fim_yr
 
             # other relvant metadata from NWS sourced scraping
             if gage_json['upstreamLid'] == "":
@@ -462,9 +591,10 @@ def get_site_info(fims_df, aoi):
                         logging.info(lid + ' has malformed epoch') # msbm8 11/14/2019
 
             else:
-                dem_resolution = partner_df[partner_df['ahps_lid'] == lid]['dem_res_m'].iloc[0]
-                dem_yr = partner_df[partner_df['ahps_lid'] == lid]['dem_yr'].iloc[0]
-                fema_effective_date = partner_df[partner_df['ahps_lid'] == lid]['fema_eff_date'].iloc[0]
+                partner_meta = partner_dict[lid]
+                dem_resolution = partner_meta['dem_res_m']
+                dem_yr = partner_meta['dem_yr']
+                fema_effective_date = partner_meta['fema_eff_date']
 
             if len(fema_effective_date) == 0:
                 fema_older_dem = ''
@@ -474,25 +604,18 @@ def get_site_info(fims_df, aoi):
                 fema_older_dem = 'no'
             
             org_thresh_imp_df = add_meta_cols(thresh_imp_df, threshold_type, max_stg, max_flow, dem_resolution, dem_yr, ahps_fim_exist, usgs_fim_exist, usgs_fim_yr, fema_effective_date, fema_older_dem, rfc_headwater)
-            org_row = pd.DataFrame(add_meta_cols(row, threshold_type, max_stg, max_flow, dem_resolution, dem_yr, ahps_fim_exist, usgs_fim_exist, usgs_fim_yr, fema_effective_date, fema_older_dem, rfc_headwater)).T
+            # plain dict per site; the one-row frame + transpose forced a concat of many single-row frames later
+            row_dict = row._asdict()
+            del row_dict['Index']
+            org_row_dict = add_meta_cols(row_dict, threshold_type, max_stg, max_flow, dem_resolution, dem_yr, ahps_fim_exist, usgs_fim_exist, usgs_fim_yr, fema_effective_date, fema_older_dem, rfc_headwater)
 
             org_thresh_imp_df.insert(loc=0, column='lid', value=lid)
             lid_df = org_thresh_imp_df.merge(fims_df, left_on='lid', right_on='ahps_lid', how='left').drop('ahps_lid', axis=1)
             
-            if external_count == 0 and start_index == 0:
-                org_row.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + org_static_fims_fn_suffix2), index=False)
-                thresh_imp_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + nwps_impact_fn_suffix2), index=False)
-                lid_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + combined_out_fn_suffix2), index=False)
-            else:
-                org_row.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + org_static_fims_fn_suffix2), index=False, mode='a', header=False)
-                thresh_imp_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + nwps_impact_fn_suffix2), index=False, mode='a', header=False)
-                lid_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + combined_out_fn_suffix2), index=False, mode='a', header=False)
-
-            external_count += 1
-
             if (lid_df.empty == False):
                 loop_li.append(lid_df)
-            site_li.append(org_row)
+            site_li.append(org_row_dict)
+            impact_li.append(thresh_imp_df)
         elif gage_response.status == 404:
             logging.info(lid + ' has no nwps gauge metadata found, url: ' + gage_url)
 
@@ -504,43 +627,73 @@ def get_site_info(fims_df, aoi):
 
     logging.info('site scraping ended')
     return_df = pd.concat(loop_li)
-    org_static_fim_df = pd.concat(site_li)
+    org_static_fim_df = pd.DataFrame.from_records(site_li)
+
+    # low-cardinality yes/no and stage/flow columns as categoricals, so downstream holds int8
+    # codes instead of a python string object per row (csv output is unchanged)
+    for category_col in ['threshold_type', 'rfc_headwater', 'ahps_fim', 'usgs_fim']:
+        return_df[category_col] = return_df[category_col].astype('category')
+        org_static_fim_df[category_col] = org_static_fim_df[category_col].astype('category')
+
+    # single batched write per aoi instead of reopening/appending each csv every iteration
+    if start_index == 0:
+        org_static_fim_df.to_csv(org_static_fims_path, index=False)
+        pd.concat(impact_li).to_csv(nwps_impact_path, index=False)
+        return_df.to_csv(combined_out_path, index=False)
+    else:
+        # debugging reruns resume partway, so append to the files from the earlier partial run
+        org_static_fim_df.to_csv(org_static_fims_path, index=False, mode='a', header=False)
+        pd.concat(impact_li).to_csv(nwps_impact_path, index=False, mode='a', header=False)
+        return_df.to_csv(combined_out_path, index=False, mode='a', header=False)
+
     return return_df, org_static_fim_df
     
-def main():
-    stage_cols = pd.read_csv(os.path.join(ctrl_dir, stage_columns_fn))
-    flow_cols = pd.read_csv(os.path.join(ctrl_dir, flow_columns_fn))
+def process_aoi(aoi, stage_want_cols, flow_want_cols):
+    """
+    full metadata gathering for one aoi; inputs and outputs are disjoint per aoi, which is what
+    lets main() run these in separate processes
+    """
+    logging.info(aoi + ' metadata gathering has started')
 
-    stage_want_cols = stage_cols.loc[stage_cols['include'] == 'y', 'stage_fim_colnames']
-    flow_want_cols = flow_cols.loc[flow_cols['include'] == 'y', 'flow_fim_colnames']
+    stage_df = convert_fim_json_df(aoi, 'stage')
+    flow_df = convert_fim_json_df(aoi, 'flow')
 
-    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
-    aois_li = areas_df.loc[areas_df['include'] == 'x']['area'].tolist()
+    stage_want_df = stage_df.loc[:, stage_want_cols]
+    fim_want_df = flow_df.loc[:, flow_want_cols]
 
-    for aoi in aois_li:
-        logging.info(aoi + ' metadata gathering has started')
-        
-        stage_df = convert_fim_json_df(aoi, 'stage')
-        flow_df = convert_fim_json_df(aoi, 'flow')
+    stage_want_org_df = clean_stage_df(stage_want_df)
 
-        stage_want_df = stage_df.loc[:, stage_want_cols]
-        fim_want_df = flow_df.loc[:, flow_want_cols]
+    # join stage and flow static fim info and remove endlines
+    static_fims_df = stage_want_org_df.merge(fim_want_df, on='ahps_lid', suffixes=('_stage', '_flow')).replace(r'\n', '', regex=True).sort_values('ahps_lid')
 
-        stage_want_org_df = clean_stage_df(stage_want_df)
+    all_site_df, org_static_fim_df = get_site_info(static_fims_df, aoi)
 
-        # join stage and flow static fim info and remove endlines
-        static_fims_df = stage_want_org_df.merge(fim_want_df, on='ahps_lid', suffixes=('_stage', '_flow')).replace(r'\n', '', regex=True).sort_values('ahps_lid')
+    # writing out site by site instead
+    #final_df = site_df.merge(static_fims_df, left_on='lid', right_on='ahps_lid', how='left').drop('ahps_lid', axis=1)
+    #final_df.to_csv(out_dir + combined_out_fn, index=False)
 
-        all_site_df, org_static_fim_df = get_site_info(static_fims_df, aoi)
+    #site_df.to_csv(out_dir + nwps_impact_fn, index=False)
+    static_fims_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + raw_static_fims_fn_suffix2), index=False)
 
-        # writing out site by site instead
-        #final_df = site_df.merge(static_fims_df, left_on='lid', right_on='ahps_lid', how='left').drop('ahps_lid', axis=1)
-        #final_df.to_csv(out_dir + combined_out_fn, index=False)
+    logging.info(aoi + ' metadata gathering has finished')
 
-        #site_df.to_csv(out_dir + nwps_impact_fn, index=False)
-        static_fims_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + raw_static_fims_fn_suffix2), index=False)
+def main():
+    stage_cols = pd.read_csv(os.path.join(ctrl_dir, stage_columns_fn))
+    flow_cols = pd.read_csv(os.path.join(ctrl_dir, flow_columns_fn))
 
-        logging.info(aoi + ' metadata gathering has finished')
+    stage_want_cols = stage_cols.loc[stage_cols['include'] == 'y', 'stage_fim_colnames']
+    flow_want_cols = flow_cols.loc[flow_cols['include'] == 'y', 'flow_fim_colnames']
+
+    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
+    aois_li = areas_df.loc[areas_df['include'] == 'x', 'area'].tolist()
+
+    # aois are embarrassingly parallel (disjoint input and output files), so fan them out over a
+    # process pool; within each worker the site scraping is already threaded
+    worker_cnt = max(1, min(len(aois_li), os.cpu_count()))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_cnt) as executor:
+        list(executor.map(functools.partial(process_aoi,
+                                            stage_want_cols=stage_want_cols,
+                                            flow_want_cols=flow_want_cols), aois_li))
 
     logging.shutdown()
 
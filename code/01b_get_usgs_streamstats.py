@@ -1,8 +1,8 @@
 # original author(s):   henry pai (nwrfc)
 # contact info:         henry <dot> pai <at> noaa <dot> gov
 # last edit by:         hp
-# last edit time:       Oct 2024
-# last edit comment:    edited to return all USGS streamstats, and chooses non-regulatory aep's if available
+# last edit time:       Aug 2026
+# last edit comment:    performance pass, starting with concurrent usgs scraping
 
 # summary:
 # aggregates AEP stats from USGS; note NWM stats from USGS Bulletin 17C eq. 11 - implemented, but not output as values were >> usgs stats
@@ -25,30 +25,55 @@
 # [ ] need stats on annual peaks?
 # [ ] filter for low outliers? https://code.usgs.gov/water/stats/MGBT/-/tree/master?ref_type=heads
 
+import concurrent.futures
+import multiprocessing
 import os
+from collections import Counter
+import time
 import yaml
 import pathlib
-import glob
 import pandas as pd
 import numpy as np
-import scipy
 import json
 import logging
 import urllib3
-import xarray as xr
-import fsspec
 import re
-import pdb
+
+# note: scipy, xarray, and fsspec are imported lazily inside the calc_nwm path; their cold import
+# dominates startup and the nwm calc is off by default
+
+# orjson takes the raw response bytes (no utf8 decode pass) and parses several times faster than
+# stdlib json; fall back quietly when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # ===== global/user vars (not path related)
 # common AEP's of interest, leaving as strings to avoid potential rounding errors in array intersections
 aep_li = ['0.2', '1', '2', '4', '10', '20', '50']
+aep_set = frozenset(aep_li)  # hashed once for the per-gage isin filter
 calc_nwm = False
 
+# cubic meters to cubic feet, precomputed once (100 cm/m, 2.54 cm/in, 12 in/ft, all cubed)
+m3_to_f3 = (100 / 2.54 / 12)**3
+
+# threads for scraping streamstats, scraping is network-bound so well above core count
+max_fetch_workers = 32
+use_cache = True  # keeps responses on disk so reruns skip the network while iterating on org_usgs
+cache_ttl_hr = 24
+
 # mapping stat type to first word of description
 stat_dict = {'WPK' : 'weighted', 'PK' : 'station', 'RPK' : 'regression', 'APK' : 'alternate', 'UPK' : 'urban', 'GPK' : 'regulated'}
 nws_pref_dict = {'WPK' : 1, 'PK' : 2, 'RPK' : 3, 'APK' : 4, 'UPK' : 9, 'GPK' : 10}
 
+# compiled once; pulls the leading letters (stat-type prefix) off an AEP code like 'WPK1AEP'
+code_prefix_re = re.compile(r'^[A-Za-z]+')
+
+# compiled once; pulls the percent chance out of an AEP code, e.g. 'WPK1_5AEP' -> '1_5'
+aep_code_re = re.compile(r'PK(\d+(?:_\d+)?)AEP')
+
 # ===== debugging var
 start_index = 0 # 285 crli2 for CR, good test for regulated, multiple aep methods
 #start_index = 398 # should be used when debugging, otherwise comment out
@@ -60,6 +85,8 @@ ctrl_dir = os.path.join(work_dir, "ctrl")   # csv files controlling columns and
 in_dir = os.path.join(work_dir, 'out', 'catfim')
 log_dir = os.path.join(work_dir, "logs")
 out_dir = os.path.join(work_dir, "out", "stats")
+cache_dir = os.path.join(work_dir, "cache", "usgs")  # created on demand when use_cache is on
+failed_gages_fn = 'failed_gages.json'  # gages with missing/empty streamstats pages, not retried
 
 # yaml file
 yaml_fn = 'config.yaml'
@@ -89,10 +116,17 @@ with open(os.path.join(ctrl_dir, yaml_fn)) as f:
 usgs_url_prefix = 'https://streamstats.usgs.gov/gagestatsservices/statistics?statisticGroups=pfs&stationIDOrCode='
 nwm_retro_bucket_url = 's3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr'
 
+# one pool shared across fetch threads, keeps connections alive instead of re-handshaking per
+# gage; retries cover transient streamstats hiccups and gzip roughly halves bytes on the wire
+http = urllib3.PoolManager(maxsize=max_fetch_workers,
+                           retries=urllib3.Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+                           headers={**request_header, 'Accept-Encoding' : 'gzip'})
+
 # ===== initial set up for requests and logging
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s',
                     filename=os.path.join(log_dir, log_fn),
-                    filemode='w',
+                    # aoi worker processes re-import this module; only the parent truncates the log
+                    filemode='w' if multiprocessing.current_process().name == 'MainProcess' else 'a',
                     #level=logging.DEBUG,
                     level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
@@ -102,75 +136,79 @@ def org_usgs(usgs_json, ahps_lid):
     """
     pulls in relevant usgs streamstats for thresholds listed in the global var aep_li
     """
-    temp_df = pd.DataFrame(usgs_json)
-    
-    # changing some of the order here, would like to take all the USGS AEP's, preferred or not, then do the temporary data frame
-    temp_select_cols_df = pd.concat([temp_df['isPreferred'],
-                                     temp_df[['value', 'citationID']],
-                                     pd.json_normalize(temp_df['regressionType'])], axis=1)
-    
+    # taking all the USGS AEP's, preferred or not; the nested regressionType dict has a small
+    # fixed schema, so build the frame straight from the json with just the columns used
+    # downstream instead of json_normalize + horizontal concat + drop
+    temp_select_cols_df = pd.DataFrame([{'isPreferred' : stat['isPreferred'],
+                                         'value' : stat['value'],
+                                         'citationID' : stat['citationID'],
+                                         'code' : stat['regressionType']['code'],
+                                         'name' : stat['regressionType']['name']} for stat in usgs_json])
+
     # pulling AEP rows
-    aep_all_df = temp_select_cols_df[temp_select_cols_df['code'].str.contains('AEP')]\
-                                                                .drop(['id', 
-                                                                       'metricUnitTypeID',
-                                                                       'englishUnitTypeID',
-                                                                       'statisticGroupTypeID',
-                                                                       'description'], axis=1)\
-                                                                .reset_index(drop=True)
+    aep_all_df = temp_select_cols_df[temp_select_cols_df['code'].str.contains('AEP')].reset_index(drop=True)
 
     if aep_all_df.empty:
-        # case where json is present but no AEP stats (lilc2, usgs: 09260000)
-        final_pref_df = aep_all_df.copy()
-        usgs_aeps_df = aep_all_df.copy()
+        # case where json is present but no AEP stats (lilc2, usgs: 09260000); bail before any of
+        # the selection work below, the caller skips empty frames
         logging.info(ahps_lid + ' has a json, but no AEP stats')
+        aep_all_df.insert(0, 'nws_pref', False)
+        return(aep_all_df, aep_all_df)
     else:
-        # pulling AEP numeric values
-        usgs_aeps = aep_all_df['code'].str.rstrip('AEP')\
-                                      .str.split('PK', expand=True)[1]\
-                                      .str.replace('_', '.')
+        # pulling AEP numeric values in one extract pass, then masking directly instead of the
+        # np.in1d/nonzero index roundtrip
+        usgs_aeps = aep_all_df['code'].str.extract(aep_code_re, expand=False)\
+                                      .str.replace('_', '.', regex=False)
 
-        usgs_row_idxs = np.nonzero(np.in1d(usgs_aeps, aep_li))[0].tolist()  # getting row indices from aep percent to then pluck from perf_df
+        aep_mask = usgs_aeps.isin(aep_set)
 
-        usgs_aeps_df = aep_all_df.copy().iloc[usgs_row_idxs].reset_index(drop=True)
-        usgs_aeps_df['aep_percent'] = [float(i) for i in usgs_aeps[usgs_row_idxs].reset_index(drop=True)]
+        usgs_aeps_df = aep_all_df.loc[aep_mask].reset_index(drop=True)
+        usgs_aeps_df['aep_percent'] = usgs_aeps[aep_mask].astype(float).to_numpy()
 
         usgs_aeps_df.rename(columns={'value' : 'usgsFlow_cfs',
                                      'isPreferred' : 'usgs_pref',
                                      'name' : 'usgs_name'}, inplace=True)
                                      #'description' : 'usgs_description'}, inplace=True)
 
-        # second answer: https://stackoverflow.com/questions/9987483/elif-in-list-comprehension-conditionals
-        usgs_aeps_df['usgs_stat_type'] = [stat_dict.get(re.sub(r'\d+', ' ', code).split(' ')[0], 'other') for code in usgs_aeps_df['code']]
-        usgs_aeps_df['nws_pref_order'] = [nws_pref_dict.get(re.sub(r'\d+', ' ', code).split(' ')[0], 5) for code in usgs_aeps_df['code']]
+        # classify from the leading letters of the code in one vectorized pass rather than
+        # per-row re.sub/split comprehensions
+        code_prefix = usgs_aeps_df['code'].str.extract(r'^([A-Za-z]+)', expand=False)
+        usgs_aeps_df['usgs_stat_type'] = code_prefix.map(stat_dict).fillna('other')
+        usgs_aeps_df['nws_pref_order'] = code_prefix.map(nws_pref_dict).fillna(5).astype(int)
         usgs_aeps_df.loc[usgs_aeps_df['usgs_stat_type'] == 'regulated', 'usgs_pref'] = False  # regulated should be used as last result, want naturalized flow
-        pref_df = usgs_aeps_df[usgs_aeps_df['usgs_pref'] == True]
+        pref_df = usgs_aeps_df[usgs_aeps_df['usgs_pref'].fillna(False).astype(bool)]
+
+        # cached locals so the branches below don't rescan the same columns
+        n_aep = len(aep_li)
 
         if pref_df.empty:
             logging.info(ahps_lid + ' : no preferred usgs stats, choose by nws_pref_order: weighted, station, regression, alternate, other, regulated')
 
-            if len(usgs_aeps_df.index) > len(aep_li):
-                test_pref_df = usgs_aeps_df.copy().loc[usgs_aeps_df['nws_pref_order'] == usgs_aeps_df.nws_pref_order.min()]
-                if len(test_pref_df) > len(aep_li):
+            if len(usgs_aeps_df.index) > n_aep:
+                min_rank = usgs_aeps_df['nws_pref_order'].min()
+                test_pref_df = usgs_aeps_df.loc[usgs_aeps_df['nws_pref_order'] == min_rank]
+                if len(test_pref_df) > n_aep:
                     # needed for mhpp1 in marfc
-                    most_frequent_cite = test_pref_df.citationID.mode()[0]
+                    most_frequent_cite = test_pref_df['citationID'].value_counts().index[0]
                     final_pref_df = test_pref_df[test_pref_df.citationID == most_frequent_cite].sort_values('usgsFlow_cfs')
                     logging.info(ahps_lid + ' has multiple flows per percent, most frequent citation chosen')
                 else:
                     # needed for pdes1
                     final_pref_df = test_pref_df.sort_values('usgsFlow_cfs')
             else:
-                final_pref_df = usgs_aeps_df.copy().sort_values('usgsFlow_cfs')
+                final_pref_df = usgs_aeps_df.sort_values('usgsFlow_cfs')
             logging.info(ahps_lid + ' has a no usgs preferred designation')
         else:
             # if there are many preferred, choose weighted (email 2024 Mar).  else choose empirical
-            if len(pref_df.index) > len(aep_li):
-                test_pref_df = pref_df.loc[pref_df['nws_pref_order'] == pref_df.nws_pref_order.min()]
+            if len(pref_df.index) > n_aep:
+                min_rank = pref_df['nws_pref_order'].min()
+                test_pref_df = pref_df.loc[pref_df['nws_pref_order'] == min_rank]
                 logging.info(ahps_lid + ' : many preferred usgs stats, choose by nws_pref_order: weighted, station, regression, alternate, other, regulated')
-                
+
                 # if the preferred has old citations, choose the most frequent citation (ensures one flow per percent)
                 # coss2 (usgs: 06482610) is an example
-                if len(test_pref_df) > len(aep_li):
-                    most_frequent_cite = test_pref_df.citationID.mode()[0]
+                if len(test_pref_df) > n_aep:
+                    most_frequent_cite = test_pref_df['citationID'].value_counts().index[0]
                     assign_pref_df = test_pref_df[test_pref_df.citationID == most_frequent_cite]
                     logging.info(ahps_lid + ' has multiple flows per percent, most frequent citation chosen')
                 else:
@@ -179,9 +217,9 @@ def org_usgs(usgs_json, ahps_lid):
             else:
                 # so, some exception handling as aftw3 (usgs: 05430500) has two methods that are 'preferred'
                 # so handling the by choosing the most 'frequent' preferred method
-                code_desc = [re.sub(r'\d+', ' ', code).split(' ')[0] for code in pref_df['code']]
+                code_desc = [code_prefix_re.match(code).group(0) for code in pref_df['code']]
 
-                most_frequent_code = pd.Series(code_desc).mode()[0]  #most frequent
+                most_frequent_code = Counter(code_desc).most_common(1)[0][0]  #most frequent
 
                 most_frequent_df = pref_df.iloc[[i for i, desc in enumerate(code_desc) if desc == most_frequent_code]]
                 if len(pref_df) != len(most_frequent_df):
@@ -190,17 +228,19 @@ def org_usgs(usgs_json, ahps_lid):
                 assign_pref_df = most_frequent_df
 
             # sorting
-            final_pref_df = assign_pref_df.copy().sort_values('usgsFlow_cfs')
+            final_pref_df = assign_pref_df.sort_values('usgsFlow_cfs')
 
-    # inserting nws/my preference
-    same_row_ids = pd.merge(usgs_aeps_df.reset_index(), final_pref_df, on=final_pref_df.columns.tolist())['index'].tolist()
+    # inserting nws/my preference; final_pref_df rows are slices of usgs_aeps_df that kept their
+    # original index, so flag them directly instead of merging on every column
     usgs_aeps_df.insert(0, 'nws_pref', False)
-    usgs_aeps_df.loc[same_row_ids, ['nws_pref']] = True
+    usgs_aeps_df.loc[final_pref_df.index, 'nws_pref'] = True
 
     return(final_pref_df, usgs_aeps_df)
 
-def org_nwm(nwm_ds, water_yr):
+def org_nwm(yr_pks_2d, feature_ids):
     """
+    inputs are the (gage, year) array of annual water-year peak flows (cms) and the matching
+    feature ids; returns a long frame of nwm_seg/aep_percent/nwmFlow_cfs for every gage
     solves for Eq 11 for USGS Bulletin 17C, Chapter 5 of Book 4 for AEP estimates.  This should be similar to WRDS estimates, but does NOT perform
     low-outlier tests
 
@@ -212,159 +252,253 @@ def org_nwm(nwm_ds, water_yr):
     (Multiple Grubbs-Beck Low-Outlier Test) to identify and remove PILF (Potentially Influential Low Flows), and a frequency factor (k) which is a
     function of the skew coefficient (G).'
     """
-    m3_to_f3 = 100**3 / (2.54**3) / (12**2)
-    yr_pks = nwm_ds.groupby(water_yr).max().values # time consuming step & heavy download; also groupby coordinate?
-    mean_pks = yr_pks.mean()
-    std_pks = np.std(yr_pks)
-    skew_pks = scipy.stats.skew(yr_pks)
+    import scipy.special
+    import scipy.stats
+
+    # moments broadcast across gages in single C-level calls instead of per-gage python loops
+    mean_pks = yr_pks_2d.mean(axis=1)
+    std_pks = np.std(yr_pks_2d, axis=1)
+    skew_pks = scipy.stats.skew(yr_pks_2d, axis=1)
 
     alpha = 4 / (skew_pks**2)
     beta = np.sign(skew_pks) * (((std_pks**2) / alpha)**0.5)
     tau = mean_pks - alpha * beta
 
-    q_li = [1 - float(aep_str)/100 for aep_str in aep_li]
-    x_q_li = [round((tau + beta * (scipy.special.gammaincinv(alpha, q))) * m3_to_f3) for q in q_li]
+    # gammaincinv is a ufunc, so one (gage, aep) broadcast covers everything
+    q_arr = 1 - np.array(aep_li, dtype=float) / 100
+    x_q = np.round((tau[:, None] + beta[:, None] * scipy.special.gammaincinv(alpha[:, None], q_arr[None, :])) * m3_to_f3).astype(int)
 
-    return_df = pd.DataFrame()
-    return_df['aep_percent'] = aep_li
-    return_df['nwmFlow_cfs'] = x_q_li
+    return_df = pd.DataFrame({'nwm_seg' : np.repeat(feature_ids, len(aep_li)),
+                              'aep_percent' : np.tile(aep_li, len(feature_ids)),
+                              'nwmFlow_cfs' : x_q.ravel()})
 
     return(return_df)
 
-def insert_site_meta(df, row):
-    ''' just adding to start of dataframe'''
-    df.insert(0, 'ratingMax_cfs', row.rating_max_flow)
-    df.insert(0, 'nwm_streamOrder', row.nwm_feature_data_stream_order)
-    df.insert(0, 'rfc_headwater', row.rfc_headwater)
-    df.insert(0, 'wfo', row.nws_data_wfo)
-    df.insert(0, 'hsa', row.nws_data_hsa)
-    df.insert(0, 'ahps_lid', row.ahps_lid)
-    
+def site_meta(row):
+    ''' site metadata leading each output row, in the same order the old column inserts gave'''
+    return {'ahps_lid' : row.ahps_lid,
+            'hsa' : row.nws_data_hsa,
+            'wfo' : row.nws_data_wfo,
+            'rfc_headwater' : row.rfc_headwater,
+            'nwm_streamOrder' : row.nwm_feature_data_stream_order,
+            'ratingMax_cfs' : row.rating_max_flow}
+
+
+def latest_file(dir_path, fn_suffix):
+    """
+    newest file in dir_path ending with fn_suffix; scandir entries cache their stat, so this is
+    one syscall per file instead of glob's stat plus getctime's stat
+    """
+    with os.scandir(dir_path) as entries:
+        return max((entry for entry in entries if entry.name.endswith(fn_suffix)),
+                   key=lambda entry: entry.stat().st_ctime).path
+
+def cache_is_fresh(cache_fullfn):
+    """true if the cache file exists and is younger than the ttl"""
+    return os.path.exists(cache_fullfn) and (time.time() - os.path.getmtime(cache_fullfn)) < cache_ttl_hr * 3600
+
+def load_failed_gages():
+    """gages that came back missing/empty on a prior run; outlives the response ttl"""
+    failed_fullfn = os.path.join(cache_dir, failed_gages_fn)
+    if use_cache and os.path.exists(failed_fullfn):
+        with open(failed_fullfn, 'rb') as failed_f:
+            return set(json_loads(failed_f.read()))
+    return set()
+
+def save_failed_gages(failed_gages):
+    failed_fullfn = os.path.join(cache_dir, failed_gages_fn)
+    if use_cache and failed_gages:
+        os.makedirs(cache_dir, exist_ok=True)
+        # aoi workers all write this file; re-read and union so the last writer doesn't drop
+        # gages another aoi just recorded (os.replace keeps the write itself atomic)
+        failed_gages = failed_gages | load_failed_gages()
+        tmp_fullfn = failed_fullfn + '.tmp'
+        with open(tmp_fullfn, 'w') as failed_f:
+            json.dump(sorted(failed_gages), failed_f)
+        os.replace(tmp_fullfn, failed_fullfn)
+
+def fetch_gage_json(usgs_num_str):
+    """
+    single streamstats GET, returns raw response bytes; runs in fetch threads
+    reruns within the ttl read from the on-disk cache instead of the network
+    """
+    cache_fullfn = os.path.join(cache_dir, usgs_num_str + '.json')
+    if use_cache and cache_is_fresh(cache_fullfn):
+        with open(cache_fullfn, 'rb') as cache_f:
+            return cache_f.read()
+
+    usgs_url = usgs_url_prefix + usgs_num_str
+    usgs_response = http.request('GET', usgs_url)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write-then-replace keeps the cache atomic if a run is killed mid-write
+        tmp_fullfn = cache_fullfn + '.tmp'
+        with open(tmp_fullfn, 'wb') as cache_f:
+            cache_f.write(usgs_response.data)
+        os.replace(tmp_fullfn, cache_fullfn)
+
+    return usgs_response.data
+
 def get_site_info(mapping_df, aoi, ds):
     """
     loop through getting usgs streamstats and attempted NWM retrospective v3 streamstats
     """
-    pref_li = []
-    all_li = []
-    
-    external_count = 0
-    for i, row in mapping_df.iloc[start_index:].iterrows():
+    # accumulating plain per-row dicts and building each frame once at the end skips the
+    # per-site column inserts and the final concat over hundreds of small frames
+    pref_records = []
+    all_records = []
+
+    # fetch all streamstats responses up front with a thread pool, overlapping request latency
+    # across sites; the loop below then only parses/organizes
+    sub_df = mapping_df.iloc[start_index:]
+    # zero-pad the whole gage column once rather than per row inside the loop
+    sub_df = sub_df.assign(usgs_num_str=sub_df['usgs_gage'].astype(str).str.zfill(8))
+    failed_gages = load_failed_gages()
+    usgs_num_strs = [usgs_num_str for usgs_num_str in sub_df.loc[sub_df['usgs_gage'] != 0, 'usgs_num_str']
+                     if usgs_num_str not in failed_gages]
+    if use_cache:
+        hit_cnt = sum(cache_is_fresh(os.path.join(cache_dir, usgs_num_str + '.json')) for usgs_num_str in usgs_num_strs)
+        logging.info(aoi + ' cache hits: ' + str(hit_cnt) + ' of ' + str(len(usgs_num_strs)) + ' gages')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_fetch_workers) as executor:
+        json_by_gage = dict(zip(usgs_num_strs, executor.map(fetch_gage_json, usgs_num_strs)))
+
+    if calc_nwm:
+        # select every gage's reach and the retro window once, then compute all water-year
+        # (oct-sep) peaks in a single dask graph; time-contiguous chunks mean each remote read
+        # pulls a full series, and the per-row work below is pure in-memory indexing
+        # mapping feature ids to positions once keeps the reach select from hashing the whole
+        # (~2.7M entry) coord index per label
+        # as of 2024 Sep, the retro run goes from 1979 Feb to 2023 Feb
+        fid_to_pos = pd.Series(np.arange(ds.sizes['feature_id']), index=ds['feature_id'].values)
+        seg_positions = fid_to_pos.loc[sub_df.loc[sub_df['usgs_gage'] != 0, 'nwm_seg'].unique()].to_numpy()
+        ds_sub = ds['streamflow'].isel(feature_id=seg_positions)\
+                                 .sel(time=slice('1979-10-01', '2022-09-30'))\
+                                 .chunk({'time' : -1, 'feature_id' : 256})
+        yr_pks_da = ds_sub.resample(time='AS-OCT').max(dim='time').compute()
+        nwm_aep_df = org_nwm(yr_pks_da.transpose('feature_id', 'time').values,
+                             yr_pks_da['feature_id'].values)
+
+    # itertuples skips the per-row Series boxing iterrows pays; attribute access is unchanged
+    for row in sub_df.itertuples():
         if row.usgs_gage != 0:  # this line is kept to make sure debugging is easier iterating via catfim metadata file
-            
-            usgs_num_str = str(row.usgs_gage).zfill(8)
+
+            usgs_num_str = row.usgs_num_str
 
             if len(usgs_num_str) != 8:
                 logging.info(row.ahps_lid + ' has wrong number of digts')
-                        
-            http = urllib3.PoolManager()
-            usgs_url = usgs_url_prefix + usgs_num_str
-            usgs_response = http.request('GET', usgs_url, headers=request_header)
-            usgs_json = json.loads(usgs_response.data.decode('utf8'))
+
+            if usgs_num_str in failed_gages:
+                logging.info(row.ahps_lid + ' skipped, page was missing/empty on a prior run')
+                continue
+
+            usgs_json = json_loads(json_by_gage[usgs_num_str])
 
             if len(usgs_json) == 0:
+                failed_gages.add(usgs_num_str)
                 logging.info(row.ahps_lid + ' missing usgs json or empty page')
             else:
-                print(str(i) + ' : ' + aoi + ' - ' + row.ahps_lid + ' = ' + str(usgs_num_str))
+                print(str(row.Index) + ' : ' + aoi + ' - ' + row.ahps_lid + ' = ' + str(usgs_num_str))
                 pref_df, all_df = org_usgs(usgs_json, row.ahps_lid)
 
-                if pref_df.empty == False:
+                if not pref_df.empty:
                     if calc_nwm:
-                        # as of 2024 Sep, the retro run goes from 1979 Feb to 2023 Feb
-                        nwm_ds = ds.sel(feature_id=row.nwm_seg)['streamflow'].sel(time=slice('1979-10-01', '2022-09-30'))
-                        water_yr = (nwm_ds.time.dt.month >=10) + nwm_ds.time.dt.year
-                        nwm_ds.coords['water_yr'] = water_yr # https://stackoverflow.com/questions/72268056/python-adding-a-water-year-time-variable-in-an-x-array
-                        nwm_df = org_nwm(nwm_ds, water_yr)
+                        nwm_df = nwm_aep_df.loc[nwm_aep_df['nwm_seg'] == row.nwm_seg, ['aep_percent', 'nwmFlow_cfs']]
 
                         site_df = nwm_df.merge(pref_df, how='left', on='aep_percent')
                     else:
                         site_df = pref_df
                     
-                    insert_site_meta(site_df, row)
-                    insert_site_meta(all_df, row)
-
-                    """ below is commented out to write to file one time in main section.  ensures simple_df is written correctly via column
-                    simple_df = site_df[['ahps_lid', 
-                                        'wfo', 
-                                        'rfc_headwater',
-                                        'usgs_stat_type', 
-                                        'ratingMax_cfs', 
-                                        'usgsFlow_cfs', 
-                                        'aep_percent']].pivot(index=['ahps_lid', 'wfo', 'rfc_headwater', 'usgs_stat_type', 'ratingMax_cfs'],
-                                                            columns='aep_percent', 
-                                                            values='usgsFlow_cfs') 
-                    
-                    if external_count == 0 and start_index == 0:
-                        site_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + full_usgs_fn_suffix), index=False)
-                        simple_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + slim_usgs_fn_suffix))
-                    else:
-                        site_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + full_usgs_fn_suffix), index=False, mode='a', header=False)
-                        simple_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + slim_usgs_fn_suffix), mode='a', header=False)
-                    """
+                    meta_dict = site_meta(row)
+                    pref_records.extend({**meta_dict, **rec} for rec in site_df.to_dict('records'))
+                    all_records.extend({**meta_dict, **rec} for rec in all_df.to_dict('records'))
 
-                    logging.info(str(i) + ' : ' + aoi + ' - ' + row.ahps_lid + ' = ' + str(usgs_num_str))
+                    logging.info(str(row.Index) + ' : ' + aoi + ' - ' + row.ahps_lid + ' = ' + str(usgs_num_str))
 
-                    external_count += 1
-                    pref_li.append(site_df)
-                    all_li.append(all_df)
+    save_failed_gages(failed_gages)
 
     logging.info('scraping done')
-    return_pref_df = pd.concat(pref_li)
-    return_all_df = pd.concat(all_li)
+    return_pref_df = pd.DataFrame.from_records(pref_records)
+    return_all_df = pd.DataFrame.from_records(all_records)
 
     return(return_pref_df, return_all_df)
     
-def main():
-    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
-    aois_li = areas_df.loc[areas_df['include'] == 'x']['area'].tolist()
-    
+def process_aoi(aoi):
+    """
+    full streamstats gathering for one aoi; inputs and outputs are disjoint per aoi, which is what
+    lets main() run these in separate processes
+    """
+    logging.info(aoi + ' streamstats gathering has started')
+
     if calc_nwm:
+        import xarray as xr
+        import fsspec
+
+        # zarr handles do not pickle, so each worker opens its own
         logging.info('loading begun for NWM retro bucket')
         ds = xr.open_zarr(fsspec.get_mapper(nwm_retro_bucket_url, anon=True),consolidated=True)
         logging.info('loading complete for NWM retro bucket')
     else:
         ds = None
 
-    for aoi in aois_li:
-        logging.info(aoi + ' streamstats gathering has started')
-        files_li = glob.glob(in_dir + '/*_' + aoi + catfim_meta_fn_suffix2)
-        last_catfim_fullfn = max(files_li, key=os.path.getctime)
-        logging.info(aoi + ' is using ' + last_catfim_fullfn + ' for getting stats')
-        catfim_df = pd.read_csv(last_catfim_fullfn)
-        
-        usgs_map_df = catfim_df[['ahps_lid',
-                                 'nwm_seg',
-                                 'usgs_gage',
-                                 'nws_data_wfo',
-                                 'nws_data_hsa',
-                                 'rfc_headwater',
-                                 'nwm_feature_data_stream_order',
-                                 'rating_max_flow']].drop_duplicates().reset_index(drop=True)
-
-        if len(catfim_df) > len(usgs_map_df):
-            # alaska/hawaii has some duplicate rows for nlih1
-            print('there are duplicate rows from the catfim meta file')
-            logging.info(aoi + ' has duplicate rows in ' + last_catfim_fullfn)
-        
-        stats_df, all_df = get_site_info(usgs_map_df, aoi, ds)
-
-        all_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + full_usgs_fn_suffix2), index=False)
-
-        simple_df = stats_df[['ahps_lid', 
-                              'wfo', 
-                              'hsa',
-                              'rfc_headwater',
-                              'nwm_streamOrder',
-                              'usgs_stat_type', 
-                              'ratingMax_cfs', 
-                              'usgsFlow_cfs', 
-                              'aep_percent']].pivot(index=['ahps_lid', 'wfo', 'hsa', 'rfc_headwater', 'nwm_streamOrder', 'usgs_stat_type', 'ratingMax_cfs'],
-                                                    columns='aep_percent', 
-                                                    values='usgsFlow_cfs') 
-        
-        simple_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + slim_usgs_fn_suffix2))
-
-        logging.info(aoi + ' streamstats gathering has finished')
-    
+    last_catfim_fullfn = latest_file(in_dir, '_' + aoi + catfim_meta_fn_suffix2)
+    logging.info(aoi + ' is using ' + last_catfim_fullfn + ' for getting stats')
+    # only the mapping columns are used, so skip parsing the rest of the wide catfim meta file
+    catfim_df = pd.read_csv(last_catfim_fullfn, usecols=['ahps_lid',
+                                                         'nwm_seg',
+                                                         'usgs_gage',
+                                                         'nws_data_wfo',
+                                                         'nws_data_hsa',
+                                                         'rfc_headwater',
+                                                         'nwm_feature_data_stream_order',
+                                                         'rating_max_flow'])
+
+    usgs_map_df = catfim_df.drop_duplicates().reset_index(drop=True)
+
+    if len(catfim_df) > len(usgs_map_df):
+        # alaska/hawaii has some duplicate rows for nlih1
+        print('there are duplicate rows from the catfim meta file')
+        logging.info(aoi + ' has duplicate rows in ' + last_catfim_fullfn)
+
+    stats_df, all_df = get_site_info(usgs_map_df, aoi, ds)
+
+    all_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + full_usgs_fn_suffix2), index=False, chunksize=50000)
+
+    # integer category codes group faster than re-hashing the repeated strings
+    stats_df = stats_df.astype({'ahps_lid' : 'category',
+                                'wfo' : 'category',
+                                'hsa' : 'category',
+                                'rfc_headwater' : 'category',
+                                'usgs_stat_type' : 'category'})
+
+    # groupby + unstack yields the same wide shape as pivot without pivot's duplicate-key check;
+    # sort=False also keeps sites in scrape order instead of paying for a sort, observed keeps
+    # the categoricals from expanding to every unused key combination, and dropna=False keeps
+    # sites with a missing key column (empty hsa/wfo/streamOrder happen in catfim meta) like
+    # pivot did
+    simple_df = stats_df.groupby(['ahps_lid',
+                                  'wfo',
+                                  'hsa',
+                                  'rfc_headwater',
+                                  'nwm_streamOrder',
+                                  'usgs_stat_type',
+                                  'ratingMax_cfs',
+                                  'aep_percent'], sort=False, observed=True, dropna=False)['usgsFlow_cfs'].first().unstack('aep_percent')
+
+    simple_df.to_csv(os.path.join(out_dir, out_fn_prefix + aoi + slim_usgs_fn_suffix2))
+
+    logging.info(aoi + ' streamstats gathering has finished')
+
+def main():
+    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
+    aois_li = areas_df.loc[areas_df['include'] == 'x', 'area'].tolist()
+
+    # aois are embarrassingly parallel (disjoint input and output files), so fan them out over a
+    # process pool; within each worker the scraping is already threaded
+    worker_cnt = max(1, min(len(aois_li), os.cpu_count()))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_cnt) as executor:
+        list(executor.map(process_aoi, aois_li))
+
     logging.shutdown()
 
 if __name__ == '__main__':
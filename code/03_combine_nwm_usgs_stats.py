@@ -1,8 +1,8 @@
 # original author(s):   henry pai (nwrfc)
 # contact info:         henry <dot> pai <at> noaa <dot> gov
 # last edit by:         hp
-# last edit time:       Nov 2024
-# last edit comment:    handling oconus
+# last edit time:       Aug 2026
+# last edit comment:    performance pass, fewer merges and lighter file reads
 
 # summary:
 # Motivated by Table 4 in https://doi.org/10.5194/nhess-19-2405-2019 - essentially as nMAE rises > 60%, FIM accuracy degrades significantly
@@ -33,19 +33,18 @@
 # [ ] highlight values of > 60% absolute error
 # [ ] double check method FIM/GID are using WRDS estimate
 
+import concurrent.futures
+import multiprocessing
 import os
 import pathlib
-import glob
 import pandas as pd
-import functools
-import operator
+import numpy as np
 import logging
 import urllib
 import urllib3
 import json
 import yaml
 import re
-import pdb
 
 # ===== global/user vars (not path related)
 # common AEP's of interest, leaving as strings to avoid potential rounding errors in array intersections
@@ -101,12 +100,22 @@ pr_flowline_base_url = 'https://maps.water.noaa.gov/server/rest/services/referen
 # ===== initial set up for requests and logging
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s',
                     filename=os.path.join(log_dir, log_fn),
-                    filemode='w',
+                    # aoi worker processes re-import this module; only the parent truncates the log
+                    filemode='w' if multiprocessing.current_process().name == 'MainProcess' else 'a',
                     #level=logging.DEBUG,
                     level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 # ===== functions
+def latest_file(dir_path, fn_suffix):
+    """
+    newest file in dir_path ending with fn_suffix; one scandir pass with cached stats instead of
+    glob plus a stat call per match
+    """
+    with os.scandir(dir_path) as entries:
+        return max((entry for entry in entries if entry.name.endswith(fn_suffix)),
+                   key=lambda entry: entry.stat().st_ctime).path
+
 def org_nwm_aeps(nwm_seg_df, aoi, region):
     """
     inputs: aep (one percentile value at a time) copy & paste nwm files, region of interest
@@ -143,21 +152,26 @@ def org_nwm_aeps(nwm_seg_df, aoi, region):
     else:
         loop_li = []
         if yaml_data['nwm_aep_src'] == 'offline':
+            # lid/segment mapping keyed once; each aep column is then an O(N) reindex on the
+            # segment index instead of a fresh left merge
+            lid_index = pd.Index(nwm_seg_df['ahps_lid'], name='ahps_lid')
+            seg_arr = nwm_seg_df['nwm_seg'].to_numpy()
             for i, aep in enumerate(aep_li):
                 # grabbing most recent copy and paste files per aep
                 aep_str = aep.zfill(2)
-                nwm_aep_files_li = glob.glob(in_nwm_aep_dir + '/*_' + aoi + '_' + aep_str + nwm_aep_fns_suffix)
-                last_nwm_aep_fullfn = max(nwm_aep_files_li, key=os.path.getctime)
-                nwm_aep_df = pd.read_csv(last_nwm_aep_fullfn, sep='\t')
+                last_nwm_aep_fullfn = latest_file(in_nwm_aep_dir, '_' + aoi + '_' + aep_str + nwm_aep_fns_suffix)
+                # only two of the eleven columns are used, so skip parsing the rest (the geom
+                # strings especially) and pin the dtypes up front
+                nwm_aep_df = pd.read_csv(last_nwm_aep_fullfn, sep='\t',
+                                         usecols=['NWM Feature ID', 'Streamflow (cfs)'],
+                                         dtype={'NWM Feature ID' : 'int64', 'Streamflow (cfs)' : 'float64'})
 
                 # multiple hydro_ids, so getting unique segments.
                 # ASSUMPTION: only one aep streamflow per nwm segment
-                unique_nwm_aep_df = nwm_aep_df[['NWM Feature ID','Streamflow (cfs)']].drop_duplicates(subset='NWM Feature ID')
-                unique_nwm_aep_df.columns = ['nwm_seg', aep_str + '_nwm']
-
-                lid_nwm_aep_df = nwm_seg_df.merge(unique_nwm_aep_df, how='left').drop('nwm_seg', axis=1).set_index('ahps_lid')
+                flow_by_seg = nwm_aep_df.drop_duplicates(subset='NWM Feature ID')\
+                                        .set_index('NWM Feature ID')['Streamflow (cfs)']
 
-                loop_li.append(lid_nwm_aep_df)
+                loop_li.append(pd.Series(flow_by_seg.reindex(seg_arr).to_numpy(), index=lid_index, name=aep_str + '_nwm'))
 
             # merging/concatenating
             return_df = pd.concat(loop_li, axis=1)
@@ -214,74 +228,87 @@ def org_nwm_aeps(nwm_seg_df, aoi, region):
 
 def calc_norm_err(usgs_df, nwm_df):
     """
-    calc norm_error, straightforward but also renaming columns
+    calc norm_error on plain arrays; the columns share the zero-padded aep stem, so the nwm frame
+    is reindexed to the usgs rows/column order once instead of the strip/re-add suffix renames;
+    the nwm index is unique per lid, so the reindex fans out over repeated usgs stat-type rows
     """
-    usgs_rename_df = usgs_df.set_axis(usgs_df.columns.str.removesuffix('_usgs'), axis=1)
-    nwm_rename_df = nwm_df.set_axis(nwm_df.columns.str.removesuffix('_nwm'), axis=1)
+    aep_stems = [col.removesuffix('_usgs') for col in usgs_df.columns]
+    usgs_arr = usgs_df.to_numpy(dtype=float)
+    nwm_arr = nwm_df.reindex(index=usgs_df.index, columns=[stem + '_nwm' for stem in aep_stems])\
+                    .to_numpy(dtype=float)
 
-    norm_err_df = round(((nwm_rename_df - usgs_rename_df)/usgs_rename_df * 100), 1) 
-    return_df = norm_err_df.add_suffix('_normErr')
+    norm_err = np.round((nwm_arr - usgs_arr) / usgs_arr * 100, 1)
+    return_df = pd.DataFrame(norm_err, index=usgs_df.index, columns=[stem + '_normErr' for stem in aep_stems])
 
     return(return_df)
 
-def main():
-    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
-    aois_li = areas_df.loc[areas_df['include'] == 'x']['area'].tolist()
+def process_aoi(aoi):
+    logging.info(aoi + ' AEP stats aggregation has started for NWM source ' + yaml_data['nwm_aep_src'])
 
-    for aoi in aois_li:
-        # testing, hard code aoi while running upstream data code, which take longer to run and have more scraping requirements
-        #aoi = 'aprfc'
-        logging.info(aoi + ' AEP stats aggregation has started for NWM source ' + yaml_data['nwm_aep_src'])
-        
-        # some repetition here with script
-        catfim_files_li = glob.glob(in_catfim_dir + '/*_' + aoi + catfim_meta_fn_suffix2)
-        last_catfim_fullfn = max(catfim_files_li, key=os.path.getctime)
-        catfim_df = pd.read_csv(last_catfim_fullfn).drop_duplicates().reset_index(drop=True)
+    # some repetition here with script
+    last_catfim_fullfn = latest_file(in_catfim_dir, '_' + aoi + catfim_meta_fn_suffix2)
+    catfim_df = pd.read_csv(last_catfim_fullfn).drop_duplicates().reset_index(drop=True)
 
-        usgs_stats_files_li = glob.glob(stats_dir + '/*_' + aoi + usgs_stats_fn_suffix2)
-        usgs_last_stats_fullfn = max(usgs_stats_files_li, key=os.path.getctime)
-        usgs_df = pd.read_csv(usgs_last_stats_fullfn)
+    usgs_last_stats_fullfn = latest_file(stats_dir, '_' + aoi + usgs_stats_fn_suffix2)
+    usgs_df = pd.read_csv(usgs_last_stats_fullfn)
 
-        logging.info('catfim file loaded: ' + last_catfim_fullfn)
-        logging.info('usgs stats file loaded: ' + usgs_last_stats_fullfn)
+    logging.info('catfim file loaded: ' + last_catfim_fullfn)
+    logging.info('usgs stats file loaded: ' + usgs_last_stats_fullfn)
 
-        oconus_usgs_df = usgs_df.loc[usgs_df.ahps_lid.str.contains('|'.join(['h1', 'p4'])), ]
+    oconus_usgs_df = usgs_df.loc[usgs_df.ahps_lid.str.contains('|'.join(['h1', 'p4'])), ]
 
-        if oconus_usgs_df.empty:
-            aep_li = conus_aep_li
-        else:
-            aep_li = oconus_aep_li
+    if oconus_usgs_df.empty:
+        aep_li = conus_aep_li
+    else:
+        aep_li = oconus_aep_li
+
+    usgs_aep_cols_li = [format(float(i), '.1f') for i in aep_li]
+    usgs_aep_rename_li = [i.zfill(2) + '_usgs' for i in aep_li]
+
+    # selecting aep's of interest (leaves out 0.2 and 1)
+    usgs_aep_df = usgs_df[[*usgs_keep_cols, *usgs_aep_cols_li]]
 
-        usgs_aep_cols_li = [format(float(i), '.1f') for i in aep_li]
-        usgs_aep_rename_li = [i.zfill(2) + '_usgs' for i in aep_li]
+    # renaming usgs cols, 2nd answer: https://stackoverflow.com/questions/47343838/how-to-change-column-names-in-pandas-dataframe-using-a-list-of-names
+    usgs_org_df = usgs_aep_df.rename(columns=dict(zip(usgs_aep_cols_li, usgs_aep_rename_li))).set_index('ahps_lid')
 
-        # selecting aep's of interest (leaves out 0.2 and 1), reduce and add help flatten lists
-        usgs_aep_df = usgs_df[functools.reduce(operator.add, [usgs_keep_cols, usgs_aep_cols_li])]
+    # slim stats can carry a lid twice (one row per usgs_stat_type), so dedupe here to keep the
+    # lid -> seg mapping one row per lid; the nwm frames stay uniquely indexed for the reindex
+    # alignment in calc_norm_err and the final concat
+    nwm_seg_df = usgs_df[['ahps_lid']].merge(catfim_df[['ahps_lid', 'nwm_seg']])\
+                                      .drop_duplicates('ahps_lid')
 
-        # renaming usgs cols, 2nd answer: https://stackoverflow.com/questions/47343838/how-to-change-column-names-in-pandas-dataframe-using-a-list-of-names 
-        usgs_org_df = usgs_aep_df.rename(columns=dict(zip(usgs_aep_cols_li, usgs_aep_rename_li))).set_index('ahps_lid')
+    hi_seg_df = nwm_seg_df[nwm_seg_df.ahps_lid.str.contains('h1')] # hawaii
+    pr_seg_df = nwm_seg_df[nwm_seg_df.ahps_lid.str.contains('p4')] # puerto rico/virgin islands
+    conus_seg_df = pd.concat([nwm_seg_df, hi_seg_df, pr_seg_df]).drop_duplicates(keep=False)
 
-        nwm_seg_df = usgs_df[['ahps_lid']].merge(catfim_df[['ahps_lid', 'nwm_seg']])
+    conus_stats_df = org_nwm_aeps(conus_seg_df, aoi, "conus")
+    hi_stats_df = org_nwm_aeps(hi_seg_df, aoi, "hi")
+    pr_stats_df = org_nwm_aeps(pr_seg_df, aoi, "pr")
 
-        hi_seg_df = nwm_seg_df[nwm_seg_df.ahps_lid.str.contains('h1')] # hawaii
-        pr_seg_df = nwm_seg_df[nwm_seg_df.ahps_lid.str.contains('p4')] # puerto rico/virgin islands
-        conus_seg_df = pd.concat([nwm_seg_df, hi_seg_df, pr_seg_df]).drop_duplicates(keep=False)
+    nwm_stats_df = pd.concat([hi_stats_df, pr_stats_df, conus_stats_df])
 
-        conus_stats_df = org_nwm_aeps(conus_seg_df, aoi, "conus")
-        hi_stats_df = org_nwm_aeps(hi_seg_df, aoi, "hi")
-        pr_stats_df = org_nwm_aeps(pr_seg_df, aoi, "pr")
+    usgs_slim_df = usgs_org_df[usgs_aep_rename_li]
+    norm_error_df = calc_norm_err(usgs_slim_df, nwm_stats_df)
 
-        nwm_stats_df = pd.concat([hi_stats_df, pr_stats_df, conus_stats_df])
-        
-        merged_df = usgs_org_df.merge(nwm_stats_df, left_index=True, right_index=True)
-        
-        usgs_slim_df = usgs_org_df[usgs_aep_rename_li]
-        norm_error_df = calc_norm_err(usgs_slim_df, nwm_stats_df)
+    # usgs rows can repeat a lid across stat types, so align the uniquely-indexed nwm stats onto
+    # the usgs index first (fans out over the repeats); all three frames then share the same
+    # index object and the concat is purely positional, no merges; keeping only lids with an nwm
+    # row matches the old inner index merges
+    nwm_aligned_df = nwm_stats_df.reindex(usgs_org_df.index)
+    final_df = pd.concat([usgs_org_df, nwm_aligned_df, norm_error_df], axis=1, copy=False)
+    final_df = final_df[final_df.index.isin(nwm_stats_df.index)]
+    final_df.to_csv(os.path.join(stats_dir, out_fn_prefix + aoi + out_fn_suffix2))
 
-        final_df = merged_df.merge(norm_error_df, left_index=True, right_index=True)
-        final_df.to_csv(os.path.join(stats_dir, out_fn_prefix + aoi + out_fn_suffix2))
+    logging.info(aoi + ' AEP stats aggregation has finished for NWM AEP data sourced ' + yaml_data['nwm_aep_src'])
+
+def main():
+    areas_df = pd.read_csv(os.path.join(ctrl_dir, areas_fn))
+    aois_li = areas_df.loc[areas_df['include'] == 'x', 'area'].tolist()
 
-        logging.info(aoi + ' AEP stats aggregation has finished for NWM AEP data sourced ' + yaml_data['nwm_aep_src'])
+    # aois are independent (own input and output files), so fan them out like the other scripts
+    worker_cnt = max(1, min(len(aois_li), os.cpu_count()))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_cnt) as executor:
+        list(executor.map(process_aoi, aois_li))
 
     logging.shutdown()
 